@@ -4,15 +4,11 @@
 # found in the LICENSE file.
 
 from __future__ import print_function
-import glob
+import functools
 import json
 import os
-import pipes
-import platform
-import re
-import shutil
 import stat
-import subprocess
+import struct
 import sys
 
 
@@ -20,8 +16,72 @@ script_dir = os.path.dirname(os.path.realpath(__file__))
 SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 # Use MSVS2017 as the default toolchain.
 CURRENT_DEFAULT_TOOLCHAIN_VERSION = '2017'
+# Default install root of VS2017 (the edition is appended to it) and default
+# Windows 10 SDK location, used when WINDOWSSDKDIR is not set. Both are None
+# when ProgramFiles(x86) is not set, so that the defaults are not probed.
+_PROGRAM_FILES_X86 = os.environ.get('ProgramFiles(x86)')
+if _PROGRAM_FILES_X86:
+  _VS2017_ROOT = os.path.join(_PROGRAM_FILES_X86, 'Microsoft Visual Studio',
+                              '2017')
+  _WINDOWS_KITS_10_DIR = os.path.join(_PROGRAM_FILES_X86, 'Windows Kits', '10')
+else:
+  _VS2017_ROOT = None
+  _WINDOWS_KITS_10_DIR = None
+# Number of threads used to copy the runtime DLLs into the output directory.
+_COPY_THREADS = 8
+# Seconds to wait for those threads. This is only there so that waiting for
+# them can be interrupted, no copy is expected to come close to it.
+_COPY_TIMEOUT = 24 * 60 * 60
+
+# Names of the CRT DLLs copied by _CopyUCRTRuntime, keyed by the suffix of the
+# release ('.dll') or debug ('d.dll') variant.
+_CRT_FILES = {
+    '.dll': ('msvcp140.dll', 'vccorlib140.dll', 'vcruntime140.dll',
+             'ucrtbase.dll'),
+    'd.dll': ('msvcp140d.dll', 'vccorlib140d.dll', 'vcruntime140d.dll',
+              'ucrtbased.dll'),
+}
+
+# List of debug files that should be copied by _CopyDebugger, the first element
+# of the tuple is the name of the file and the second indicates if it's
+# optional.
+_DEBUG_FILES = (('dbghelp.dll', False), ('dbgcore.dll', True))
+
+# Results of _RegistryGetValue keyed by (key, value). Values that could not be
+# read are stored as None.
+_registry_cache = {}
+
+
+def _Memoize(func):
+  """Caches the result of |func|, which must take no arguments, so that the
+  environment and filesystem probing it does only happens once per process.
+  Exceptions are not cached.
+  """
+  cache = []
+  @functools.wraps(func)
+  def wrapper():
+    if not cache:
+      cache.append(func())
+    return cache[0]
+  return wrapper
+
+
+@_Memoize
+def _GetCopyFileW():
+  """Return kernel32!CopyFileW on Windows, or None elsewhere. CopyFileW does the
+  copy in the kernel and preserves the file times. ctypes is only imported when
+  this is first needed.
+  """
+  if sys.platform != 'win32':
+    return None
+  import ctypes
+  copy_file_w = ctypes.windll.kernel32.CopyFileW
+  copy_file_w.argtypes = [ctypes.c_wchar_p, ctypes.c_wchar_p, ctypes.c_int]
+  copy_file_w.restype = ctypes.c_int
+  return copy_file_w
 
 
+@_Memoize
 def SetEnvironmentAndGetRuntimeDllDirs():
   """Sets up os.environ to use the depot_tools VS toolchain with gyp, and
   returns the location of the VS runtime DLLs so they can be copied into
@@ -41,9 +101,9 @@ def SetEnvironmentAndGetRuntimeDllDirs():
     # directory in order to run binaries locally, but they are needed in order
     # to create isolates or the mini_installer. Copying them to the output
     # directory ensures that they are available when needed.
-    bitness = platform.architecture()[0]
-    # When running 64-bit python the x64 DLLs will be in System32
-    x64_path = 'System32' if bitness == '64bit' else 'Sysnative'
+    # When running 64-bit python the x64 DLLs will be in System32. The pointer
+    # size gives the bitness of python without inspecting the executable.
+    x64_path = 'System32' if struct.calcsize('P') == 8 else 'Sysnative'
     x64_path = os.path.join(r'C:\Windows', x64_path)
     vs_runtime_dll_dirs = [x64_path, r'C:\Windows\SysWOW64']
 
@@ -71,18 +131,29 @@ def _RegistryGetValueUsingWinReg(key, value):
 
 
 def _RegistryGetValue(key, value):
-  try:
-    return _RegistryGetValueUsingWinReg(key, value)
-  except ImportError:
-    raise Exception('The python library _winreg not found.')
+  """Return the contents of the registry key's value, or None if it is missing.
+  Both found and missing values are cached by (key, value).
+  """
+  cache_key = (key, value)
+  if cache_key not in _registry_cache:
+    try:
+      _registry_cache[cache_key] = _RegistryGetValueUsingWinReg(key, value)
+    except ImportError:
+      raise Exception('The python library _winreg not found.')
+  return _registry_cache[cache_key]
 
 
+@_Memoize
 def GetVisualStudioVersion():
   """Return VISUAL_STUDIO_VERSION of Visual Studio.
+
+  The value is read once; later changes to the environment are ignored as the
+  toolchain is fixed for the lifetime of the process.
   """
   return os.environ.get('VISUAL_STUDIO_VERSION', CURRENT_DEFAULT_TOOLCHAIN_VERSION)
 
 
+@_Memoize
 def DetectVisualStudioPath():
   """Return path to the VISUAL_STUDIO_VERSION of Visual Studio.
   """
@@ -104,13 +175,21 @@ def DetectVisualStudioPath():
     # the registry. For details see:
     # https://blogs.msdn.microsoft.com/heaths/2016/09/15/changes-to-visual-studio-15-setup/
     # For now we use a hardcoded default with an environment variable override.
-    for path in (
-        os.environ.get('vs2017_install'),
-        os.path.join(os.environ.get('ProgramFiles(x86)'), 'Microsoft Visual Studio', '2017', 'Enterprise'),
-        os.path.join(os.environ.get('ProgramFiles(x86)'), 'Microsoft Visual Studio', '2017', 'Professional'),
-        os.path.join(os.environ.get('ProgramFiles(x86)'), 'Microsoft Visual Studio', '2017', 'Community')):
-      if path and os.path.exists(path):
-        return path
+    path = os.environ.get('vs2017_install')
+    if path and os.path.isdir(path):
+      return path
+    # List the install root once rather than probing each edition in turn.
+    editions = set()
+    if _VS2017_ROOT:
+      try:
+        editions = set(name.lower() for name in os.listdir(_VS2017_ROOT))
+      except OSError:
+        pass
+    for edition in ('Enterprise', 'Professional', 'Community'):
+      if edition.lower() in editions:
+        path = os.path.join(_VS2017_ROOT, edition)
+        if os.path.isdir(path):
+          return path
   else:
     keys = [r'HKLM\Software\Microsoft\VisualStudio\%s' % version,
             r'HKLM\Software\Wow6432Node\Microsoft\VisualStudio\%s' % version]
@@ -125,57 +204,143 @@ def DetectVisualStudioPath():
                    ' not found.') % (version_as_year))
 
 
-def _CopyRuntimeImpl(target, source, verbose=True):
+def _CopyFile(source, target):
+  """Copy |source| to |target| along with its file times. On Windows, the only
+  platform CopyDlls runs on, this is done by CopyFileW; shutil.copy2 is only a
+  portability fallback.
+  """
+  copy_file_w = _GetCopyFileW()
+  if copy_file_w:
+    # The last argument is bFailIfExists; allow overwriting |target|.
+    if not copy_file_w(source, target, 0):
+      import ctypes
+      raise ctypes.WinError()
+    return
+  import shutil
+  shutil.copy2(source, target)
+
+
+def _RemoveFileIfExists(path):
+  """Make |path| writable and delete it, if it exists."""
+  if os.path.exists(path):
+    os.chmod(path, stat.S_IWRITE | stat.S_IREAD)
+    os.unlink(path)
+
+
+def _ReplaceFile(source, target):
+  """Atomically move |source| over |target|, replacing it if it exists."""
+  if hasattr(os, 'replace'):
+    os.replace(source, target)
+  elif sys.platform == 'win32':
+    # os.rename can't overwrite an existing file on Windows with Python 2.
+    import ctypes
+    MOVEFILE_REPLACE_EXISTING = 0x1
+    if not ctypes.windll.kernel32.MoveFileExW(unicode(source), unicode(target),
+                                              MOVEFILE_REPLACE_EXISTING):
+      raise ctypes.WinError()
+  else:
+    os.rename(source, target)
+
+
+def _CopyRuntimeImpl(target, source, source_stat=None, verbose=True):
   """Copy |source| to |target| if it doesn't already exist or if it needs to be
   updated (comparing last modified time as an approximate float match as for
   some reason the values tend to differ by ~1e-07 despite being copies of the
   same file... https://crbug.com/603603).
+
+  The directory containing |target| must already exist. |source_stat| can be
+  passed by callers that have already stat'd |source|.
   """
-  if (os.path.isdir(os.path.dirname(target)) and
-      (not os.path.isfile(target) or
-       abs(os.stat(target).st_mtime - os.stat(source).st_mtime) >= 0.01)):
+  if source_stat is None:
+    source_stat = os.stat(source)
+  try:
+    target_mtime = os.stat(target).st_mtime
+  except OSError:
+    target_mtime = None
+  if (target_mtime is None or
+      abs(target_mtime - source_stat.st_mtime) >= 0.01):
     if verbose:
-      print('Copying %s to %s...' % (source, target))
-    if os.path.exists(target):
-      # Make the file writable so that we can delete it now, and keep it
-      # readable.
-      os.chmod(target, stat.S_IWRITE | stat.S_IREAD)
-      os.unlink(target)
-    shutil.copy2(source, target)
+      # This runs on _CopyRuntimesInParallel's threads, so write each line with
+      # a single call to keep lines from being interleaved.
+      sys.stdout.write('Copying %s to %s...\n' % (source, target))
+    # Copy to a temporary file and move it over |target| so that an interrupted
+    # copy never leaves a partial |target| behind. A temporary file left by an
+    # earlier interrupted copy may be read-only, so remove it first.
+    temp_target = target + '.tmp'
+    _RemoveFileIfExists(temp_target)
+    try:
+      _CopyFile(source, temp_target)
+      if target_mtime is not None:
+        # Make the file writable so that we can replace it now, and keep it
+        # readable.
+        os.chmod(target, stat.S_IWRITE | stat.S_IREAD)
+      _ReplaceFile(temp_target, target)
+    except Exception:
+      _RemoveFileIfExists(temp_target)
+      raise
     # Make the file writable so that we can overwrite or delete it later,
     # keep it readable.
     os.chmod(target, stat.S_IWRITE | stat.S_IREAD)
 
 
-def _CopyUCRTRuntime(target_dir, source_dir, target_cpu, dll_pattern, suffix):
-  """Copy both the msvcp and vccorlib runtime DLLs, only if the target doesn't
-  exist, but the target directory does exist."""
-  for file_part in ('msvcp', 'vccorlib', 'vcruntime'):
-    dll = dll_pattern % file_part
-    target = os.path.join(target_dir, dll)
-    source = os.path.join(source_dir, dll)
-    _CopyRuntimeImpl(target, source)
+def _CopyRuntimesInParallel(copies):
+  """Run _CopyRuntimeImpl for each (target, source, verbose) tuple in |copies|.
+  The copies are independent and I/O bound, so they are spread over a small
+  pool of threads.
+  """
+  def Copy(args):
+    target, source, verbose = args
+    _CopyRuntimeImpl(target, source, verbose=verbose)
+
+  import multiprocessing.pool
+  pool = multiprocessing.pool.ThreadPool(_COPY_THREADS)
+  try:
+    # Waiting without a timeout ignores Ctrl-C on Python 2.
+    pool.map_async(Copy, copies).get(_COPY_TIMEOUT)
+  finally:
+    pool.terminate()
+    pool.join()
+
+
+def _CopyUCRTRuntime(target_dir, source_dir, target_cpu, suffixes):
+  """Copy the msvcp, vccorlib, vcruntime and ucrtbase runtime DLLs for each of
+  |suffixes|, and the api-ms-win UCRT DLLs, only if the target doesn't exist or
+  is out of date. All of the copies are done as a single batch."""
+  copies = []
+  for suffix in suffixes:
+    for dll in _CRT_FILES[suffix]:
+      copies.append((os.path.join(target_dir, dll),
+                     os.path.join(source_dir, dll), True))
   # Copy the UCRT files needed by VS 2015 from the Windows SDK. This location
   # includes the api-ms-win-crt-*.dll files that are not found in the Windows
   # directory. These files are needed for component builds.
   # If WINDOWSSDKDIR is not set use the default SDK path. This will be the case
   # when DEPOT_TOOLS_WIN_TOOLCHAIN=0 and vcvarsall.bat has not been run.
-  win_sdk_dir = os.path.normpath(
-      os.environ.get('WINDOWSSDKDIR',
-                     os.path.join(os.environ.get('ProgramFiles(x86)'),
-                                  'Windows Kits', '10')))
+  win_sdk_dir = os.environ.get('WINDOWSSDKDIR', _WINDOWS_KITS_10_DIR)
+  if not win_sdk_dir:
+    raise Exception('Unable to find the Windows SDK, set WINDOWSSDKDIR.')
+  win_sdk_dir = os.path.normpath(win_sdk_dir)
   ucrt_dll_dirs = os.path.join(win_sdk_dir, 'Redist', 'ucrt', 'DLLs',
                                target_cpu)
-  ucrt_files = glob.glob(os.path.join(ucrt_dll_dirs, 'api-ms-win-*.dll'))
+  ucrt_files = [name for name in os.listdir(ucrt_dll_dirs)
+                if name.lower().startswith('api-ms-win-') and
+                   name.lower().endswith('.dll')]
   assert len(ucrt_files) > 0
-  for ucrt_src_file in ucrt_files:
-    file_part = os.path.basename(ucrt_src_file)
-    ucrt_dst_file = os.path.join(target_dir, file_part)
-    _CopyRuntimeImpl(ucrt_dst_file, ucrt_src_file, False)
-  _CopyRuntimeImpl(os.path.join(target_dir, 'ucrtbase' + suffix),
-                    os.path.join(source_dir, 'ucrtbase' + suffix))
+  for file_part in ucrt_files:
+    copies.append((os.path.join(target_dir, file_part),
+                   os.path.join(ucrt_dll_dirs, file_part), False))
+  _CopyRuntimesInParallel(copies)
+
 
+def _IsVCToolsDir(name):
+  """Return whether |name| looks like a VS2017 VC tools version, 14.x.y."""
+  if not name.startswith('14.'):
+    return False
+  parts = name.split('.')
+  return len(parts) >= 3 and parts[1].isdigit() and parts[2].isdigit()
 
+
+@_Memoize
 def FindVCToolsRoot():
   """In VS2017 the PGO runtime dependencies are located in
   {toolchain_root}/VC/Tools/MSVC/{x.y.z}/bin/Host{target_cpu}/{target_cpu}/, the
@@ -192,10 +357,12 @@ def FindVCToolsRoot():
   vc_tools_msvc_root = os.path.join(os.environ['VISUAL_STUDIO_PATH'],
       'VC', 'Tools', 'MSVC')
   for directory in os.listdir(vc_tools_msvc_root):
-    if not os.path.isdir(os.path.join(vc_tools_msvc_root, directory)):
+    # Match the name first so that only candidate entries need to be stat'd.
+    if not _IsVCToolsDir(directory):
       continue
-    if re.match('14\.\d+\.\d+', directory):
-      return os.path.join(vc_tools_msvc_root, directory, 'bin')
+    path = os.path.join(vc_tools_msvc_root, directory)
+    if os.path.isdir(path):
+      return os.path.join(path, 'bin')
   raise Exception('Unable to find the VC tools directory.')
 
 
@@ -230,18 +397,20 @@ def _CopyPGORuntime(target_dir, target_cpu):
       source = os.path.join(pgo_x64_runtime_dir, runtime)
     else:
       raise NotImplementedError("Unexpected target_cpu value: " + target_cpu)
-    if not os.path.exists(source):
+    try:
+      source_stat = os.stat(source)
+    except OSError:
       raise Exception('Unable to find %s.' % source)
-    _CopyRuntimeImpl(os.path.join(target_dir, runtime), source)
+    _CopyRuntimeImpl(os.path.join(target_dir, runtime), source, source_stat)
 
 
 def _CopyRuntime(target_dir, source_dir, target_cpu, debug):
-  """Copy the VS runtime DLLs, only if the target doesn't exist, but the target
-  directory does exist. Handles VS 2015 and VS 2017."""
-  suffix = "d.dll" if debug else ".dll"
+  """Copy the VS runtime DLLs, only if the target doesn't exist or is out of
+  date. Handles VS 2015 and VS 2017. When |debug| is set both the debug and
+  release DLLs are copied."""
+  suffixes = (".dll", "d.dll") if debug else (".dll",)
   # VS 2017 uses the same CRT DLLs as VS 2015.
-  _CopyUCRTRuntime(target_dir, source_dir, target_cpu, '%s140' + suffix,
-                    suffix)
+  _CopyUCRTRuntime(target_dir, source_dir, target_cpu, suffixes)
 
 
 def CopyDlls(target_dir, configuration, target_cpu):
@@ -257,12 +426,14 @@ def CopyDlls(target_dir, configuration, target_cpu):
   if not vs_runtime_dll_dirs:
     return
 
+  assert os.path.isdir(target_dir), '%s is not a directory' % target_dir
+
   x64_runtime, x86_runtime = vs_runtime_dll_dirs
   runtime_dir = x64_runtime if target_cpu == 'x64' else x86_runtime
-  _CopyRuntime(target_dir, runtime_dir, target_cpu, debug=False)
   if configuration == 'Debug':
     _CopyRuntime(target_dir, runtime_dir, target_cpu, debug=True)
   else:
+    _CopyRuntime(target_dir, runtime_dir, target_cpu, debug=False)
     _CopyPGORuntime(target_dir, target_cpu)
 
   _CopyDebugger(target_dir, target_cpu)
@@ -285,12 +456,11 @@ def _CopyDebugger(target_dir, target_cpu):
   if not win_sdk_dir:
     return
 
-  # List of debug files that should be copied, the first element of the tuple is
-  # the name of the file and the second indicates if it's optional.
-  debug_files = [('dbghelp.dll', False), ('dbgcore.dll', True)]
-  for debug_file, is_optional in debug_files:
+  for debug_file, is_optional in _DEBUG_FILES:
     full_path = os.path.join(win_sdk_dir, 'Debuggers', target_cpu, debug_file)
-    if not os.path.exists(full_path):
+    try:
+      source_stat = os.stat(full_path)
+    except OSError:
       if is_optional:
         continue
       else:
@@ -298,9 +468,10 @@ def _CopyDebugger(target_dir, target_cpu):
                         '"Debugging Tools for Windows" feature from the Windows'
                         ' 10 SDK.' % (debug_file, full_path))
     target_path = os.path.join(target_dir, debug_file)
-    _CopyRuntimeImpl(target_path, full_path)
+    _CopyRuntimeImpl(target_path, full_path, source_stat)
 
 
+@_Memoize
 def _GetDesiredVsToolchainHashes():
   """Load a list of SHA1s corresponding to the toolchains that we want installed
   to build with."""
@@ -315,11 +486,10 @@ def _GetDesiredVsToolchainHashes():
 
 
 def NormalizePath(path):
-  while path.endswith("\\"):
-    path = path[:-1]
-  return path
+  return path.rstrip('\\')
 
 
+@_Memoize
 def SetEnvironmentAndGetSDKDir():
   """Gets location information about the current sdk (must have been
   previously updated by 'update'). This is used for the GN build."""
@@ -327,30 +497,47 @@ def SetEnvironmentAndGetSDKDir():
 
   # If WINDOWSSDKDIR is not set, search the default SDK path and set it.
   if not 'WINDOWSSDKDIR' in os.environ:
-    default_sdk_path = os.path.join(os.environ.get('ProgramFiles(x86)'), 'Windows Kits', '10')
-    if os.path.isdir(default_sdk_path):
-      os.environ['WINDOWSSDKDIR'] = default_sdk_path
+    if _WINDOWS_KITS_10_DIR and os.path.isdir(_WINDOWS_KITS_10_DIR):
+      os.environ['WINDOWSSDKDIR'] = _WINDOWS_KITS_10_DIR
 
   return NormalizePath(os.environ['WINDOWSSDKDIR'])
 
 
-def GetToolchainDir():
-  """Gets location information about the current toolchain (must have been
-  previously updated by 'update'). This is used for the GN build."""
+def _GetToolchainInfo():
+  """Returns the location information printed by GetToolchainDir as a dict."""
   runtime_dll_dirs = SetEnvironmentAndGetRuntimeDllDirs()
   win_sdk_dir = SetEnvironmentAndGetSDKDir()
 
-  print('''vs_path = "%s"
-sdk_path = "%s"
-vs_version = "%s"
-wdk_dir = "%s"
-runtime_dirs = "%s"
-''' % (
-      NormalizePath(os.environ['VISUAL_STUDIO_PATH']),
-      win_sdk_dir,
-      GetVisualStudioVersion(),
-      NormalizePath(os.environ.get('WDK_DIR', '')),
-      os.path.pathsep.join(runtime_dll_dirs or ['None'])))
+  return {
+      'vs_path': NormalizePath(os.environ['VISUAL_STUDIO_PATH']),
+      'sdk_path': win_sdk_dir,
+      'vs_version': GetVisualStudioVersion(),
+      'wdk_dir': NormalizePath(os.environ.get('WDK_DIR', '')),
+      'runtime_dirs': os.path.pathsep.join(runtime_dll_dirs or ['None']),
+  }
+
+
+def GetToolchainDir(output_format=None):
+  """Gets location information about the current toolchain (must have been
+  previously updated by 'update'). This is used for the GN build.
+
+  If output_format is '--json' the information is printed as a single JSON
+  object, so that it can be read with the "json" input conversion of
+  exec_script, instead of as a GN scope.
+  """
+  if output_format not in (None, '--json'):
+    raise Exception('Unexpected argument: %s' % output_format)
+  info = _GetToolchainInfo()
+  if output_format == '--json':
+    sys.stdout.write(json.dumps(info, sort_keys=True))
+  else:
+    sys.stdout.write('''vs_path = "%(vs_path)s"
+sdk_path = "%(sdk_path)s"
+vs_version = "%(vs_version)s"
+wdk_dir = "%(wdk_dir)s"
+runtime_dirs = "%(runtime_dirs)s"
+''' % info)
+  sys.stdout.flush()
 
 
 def main():